@@ -1,16 +1,18 @@
 # backend/db.py
 import os
+import orjson
 from dotenv import load_dotenv
 from contextlib import contextmanager
 from typing import Optional, List
 
 from sqlalchemy import (
-    create_engine, text, Column, String, Integer, BigInteger,
+    create_engine, text, bindparam, Column, String, Integer, BigInteger,
     TIMESTAMP, JSON, Text
 )
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.sql import func
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC
 
 load_dotenv()  # load backend/.env
 
@@ -18,11 +20,26 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL not set in .env")
 
-# engine + session
-engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True)
+# engine + session; pool sized for concurrent ingest + search (env overrides)
+engine = create_engine(
+    DATABASE_URL,
+    future=True,
+    pool_pre_ping=True,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "30")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "3600")),
+    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "10")),
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 
+# text-embedding-3-large shortened via the API's `dimensions` param, stored
+# as halfvec (fp16): half the bytes per row and per distance computation
+EMBEDDING_DIM = 1024
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+
 class ImagePage(Base):
     """
     One row per PDF page processed.
@@ -41,7 +58,7 @@ class ImagePage(Base):
     keywords = Column(JSON)        # list[str]
     raw_metadata = Column(JSON)    # full JSON from OpenAI
 
-    embedding = Column(Vector(3072))  # text-embedding-3-large
+    embedding = Column(HALFVEC(EMBEDDING_DIM))
 
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), nullable=False)
 
@@ -50,6 +67,44 @@ def init_db():
     with engine.begin() as conn:
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _migrate_embedding_column(conn)
+
+def _migrate_embedding_column(conn):
+    current = conn.execute(text("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = 'image_pages'::regclass AND attname = 'embedding'
+    """)).scalar_one()
+    target = f"halfvec({EMBEDDING_DIM})"
+    if current == target:
+        return
+    # the old index's opclass doesn't apply to the new type
+    conn.execute(text("DROP INDEX IF EXISTS image_pages_embedding_hnsw"))
+    if current == f"vector({EMBEDDING_DIM})":
+        conn.execute(text(f"ALTER TABLE image_pages ALTER COLUMN embedding TYPE {target} USING embedding::{target}"))
+    else:
+        # Vectors of another size can't be converted; drop them. The next ingest
+        # re-embeds those pages from their stored raw_metadata, without vision.
+        conn.execute(text("ALTER TABLE image_pages DROP COLUMN embedding"))
+        conn.execute(text(f"ALTER TABLE image_pages ADD COLUMN embedding {target}"))
+
+def create_embedding_index():
+    """
+    HNSW index for /search. Cheaper to build once after a bulk load than to
+    maintain row by row during it.
+    """
+    with engine.begin() as conn:
+        indexdef = conn.execute(text(
+            "SELECT indexdef FROM pg_indexes WHERE indexname = 'image_pages_embedding_hnsw'"
+        )).scalar()
+        if indexdef and "halfvec_ip_ops" not in indexdef:
+            # built for another distance operator; rebuild for <#>
+            conn.execute(text("DROP INDEX image_pages_embedding_hnsw"))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS image_pages_embedding_hnsw
+            ON image_pages USING hnsw (embedding halfvec_ip_ops)
+            WITH (m = 16, ef_construction = 64)
+        """))
 
 @contextmanager
 def session_scope():
@@ -63,6 +118,44 @@ def session_scope():
     finally:
         session.close()
 
+def stored_pages(session, ids: list[str]) -> tuple[set[str], dict[str, dict]]:
+    """
+    Which of these page ids are already stored: (ids with an embedding,
+    {id: raw_metadata} for rows whose vision output is kept but whose
+    embedding was dropped). Exact ids keep the lookup on the primary-key index.
+    """
+    rows = session.execute(
+        text("""
+            SELECT id, embedding IS NOT NULL AS embedded,
+                   CASE WHEN embedding IS NULL THEN raw_metadata END AS raw_metadata
+            FROM image_pages
+            WHERE id = ANY(:ids) AND (embedding IS NOT NULL OR raw_metadata IS NOT NULL)
+        """),
+        {"ids": ids},
+    ).all()
+    embedded = {r.id for r in rows if r.embedded}
+    unembedded = {r.id: r.raw_metadata for r in rows if not r.embedded}
+    return embedded, unembedded
+
+def update_embeddings(session, vectors: dict[str, list[float]]):
+    stmt = text("UPDATE image_pages SET embedding = :embedding WHERE id = :id").bindparams(
+        bindparam("embedding", type_=HALFVEC(EMBEDDING_DIM)),
+    )
+    session.execute(stmt, [{"id": k, "embedding": v} for k, v in vectors.items()])
+
+def repoint_pages(session, ids: list[str], pdf_filename: str, pdf_path: str):
+    """
+    Point stored pages at the file's current name/path; a skipped page is
+    otherwise never rewritten.
+    """
+    session.execute(
+        text("""
+            UPDATE image_pages SET pdf_filename = :fn, pdf_path = :p
+            WHERE id = ANY(:ids) AND (pdf_filename <> :fn OR pdf_path <> :p)
+        """),
+        {"ids": ids, "fn": pdf_filename, "p": pdf_path},
+    )
+
 def upsert_image_page(
     session,
     *,
@@ -79,33 +172,81 @@ def upsert_image_page(
     embedding: Optional[list[float]],
 ):
     """
-    Insert if missing; otherwise update the existing row by id.
+    Insert if missing; otherwise update the existing row by id. One
+    INSERT ... ON CONFLICT round trip, no ORM load.
     """
-    row = session.get(ImagePage, id)
-    if row is None:
-        row = ImagePage(
-            id=id,
-            pdf_filename=pdf_filename,
-            pdf_path=pdf_path,
-            page_number=page_number,
-            width=width,
-            height=height,
-            size_bytes=size_bytes,
-            caption=caption,
-            keywords=keywords,
-            raw_metadata=raw_metadata,
-            embedding=embedding,
-        )
-        session.add(row)
-    else:
-        row.pdf_filename = pdf_filename
-        row.pdf_path = pdf_path
-        row.page_number = page_number
-        row.width = width
-        row.height = height
-        row.size_bytes = size_bytes
-        row.caption = caption
-        row.keywords = keywords
-        row.raw_metadata = raw_metadata
-        row.embedding = embedding
-    return row
+    insert_image_pages(session, [dict(
+        id=id,
+        pdf_filename=pdf_filename,
+        pdf_path=pdf_path,
+        page_number=page_number,
+        width=width,
+        height=height,
+        size_bytes=size_bytes,
+        caption=caption,
+        keywords=keywords,
+        raw_metadata=raw_metadata,
+        embedding=embedding,
+    )])
+
+# below this many rows per write, plain INSERTs beat the COPY setup cost
+COPY_THRESHOLD = 16
+
+PAGE_COLUMNS = (
+    "id", "pdf_filename", "pdf_path", "page_number", "width", "height",
+    "size_bytes", "caption", "keywords", "raw_metadata", "embedding",
+)
+
+def _vector_literal(vec: Optional[list[float]]) -> Optional[str]:
+    # pgvector text form: [v1,v2,...]
+    if vec is None:
+        return None
+    return "[" + ",".join(repr(float(v)) for v in vec) + "]"
+
+def _json_literal(value) -> Optional[str]:
+    if value is None:
+        return None
+    return orjson.dumps(value).decode()
+
+def copy_upsert_image_pages(session, rows: list[dict]):
+    """
+    Bulk upsert via COPY: stream rows into a temp staging table, then merge
+    them into image_pages in one INSERT ... ON CONFLICT.
+    """
+    cols = ", ".join(PAGE_COLUMNS)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in PAGE_COLUMNS if c != "id")
+
+    # ON COMMIT DROP (or rollback) removes it, so it never outlives this write
+    session.execute(text(
+        "CREATE TEMP TABLE image_pages_stage (LIKE image_pages INCLUDING DEFAULTS) ON COMMIT DROP"
+    ))
+
+    raw_conn = session.connection().connection  # psycopg connection, same transaction
+    with raw_conn.cursor() as cur:
+        with cur.copy(f"COPY image_pages_stage ({cols}) FROM STDIN") as copy:
+            for r in rows:
+                copy.write_row((
+                    r["id"], r["pdf_filename"], r["pdf_path"], r["page_number"],
+                    r["width"], r["height"], r["size_bytes"], r["caption"],
+                    _json_literal(r["keywords"]), _json_literal(r["raw_metadata"]),
+                    _vector_literal(r["embedding"]),
+                ))
+
+    session.execute(text(f"""
+        INSERT INTO image_pages ({cols})
+        SELECT {cols} FROM image_pages_stage
+        ON CONFLICT (id) DO UPDATE SET {updates}
+    """))
+
+def insert_image_pages(session, rows: list[dict]):
+    """
+    Upsert many rows with a single multi-VALUES INSERT ... ON CONFLICT.
+    """
+    if not rows:
+        return
+    stmt = insert(ImagePage.__table__).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["id"],
+        set_={c: stmt.excluded[c] for c in PAGE_COLUMNS if c != "id"},
+    )
+    session.execute(stmt)
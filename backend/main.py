@@ -1,21 +1,31 @@
+import asyncio
 import base64
 import hashlib
-import io
+import math
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from pathlib import Path
-from typing import Iterable, Tuple
-from pgvector.sqlalchemy import Vector   # <-- add this import
+from typing import Optional
+from pgvector.sqlalchemy import HALFVEC
 
 import fitz  # PyMuPDF
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI, Body
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
-from PIL import Image
+from openai import AsyncOpenAI
 from sqlalchemy import text, bindparam, Integer
 from fastapi import UploadFile, File
 from pathlib import Path
-from db import init_db, session_scope, upsert_image_page
+from db import (
+    COPY_THRESHOLD, EMBEDDING_DIM, HNSW_EF_SEARCH,
+    copy_upsert_image_pages, create_embedding_index, init_db,
+    insert_image_pages, repoint_pages, session_scope, stored_pages, update_embeddings,
+)
+from render import render_one
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -24,7 +34,15 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY missing in .env")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# the SDK retries 429/5xx with exponential backoff and honours Retry-After;
+# fanned-out vision calls hit rate limits more often, so allow more tries
+OPENAI_ASYNC_MAX_RETRIES = 4
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_ASYNC_MAX_RETRIES)
+
+VISION_CONCURRENCY = 8   # in-flight vision calls per PDF
+PDF_CONCURRENCY = 4      # PDFs ingested at once from a folder
+
+_DONE = object()  # end-of-stream marker between pipeline stages
 
 app = FastAPI(title="IMG Searcher Backend")
 
@@ -42,62 +60,136 @@ app.add_middleware(
 
 # ---------- Helpers ----------
 
+_sha_cache: dict[tuple[str, int, int], str] = {}  # (path, mtime_ns, size) -> sha256
+
 def file_sha256(path: Path) -> str:
-    h = hashlib.sha256()
+    st = path.stat()
+    key = (str(path.resolve()), st.st_mtime_ns, st.st_size)
+    if key in _sha_cache:
+        return _sha_cache[key]
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-def render_pdf_pages(pdf_path: Path, dpi: int = 150) -> Iterable[Tuple[int, bytes, Tuple[int, int]]]:
-    doc = fitz.open(pdf_path)
-    for i, page in enumerate(doc, start=1):
-        mat = fitz.Matrix(dpi / 72, dpi / 72)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        buf = io.BytesIO()
-        img.save(buf, format="PNG", optimize=True)
-        yield i, buf.getvalue(), (pix.width, pix.height)
-
-def png_bytes_to_data_url(png_bytes: bytes) -> str:
-    b64 = base64.b64encode(png_bytes).decode("ascii")
-    return f"data:image/png;base64,{b64}"
-
-def call_openai_vision(png_bytes: bytes) -> dict:
-    data_url = png_bytes_to_data_url(png_bytes)
-    SYSTEM = "You are an image metadata extractor. Return concise JSON only."
-    USER = (
-        "Extract this schema:\n"
-        "{\n"
-        '  "caption": "string (<= 15 words)",\n'
-        '  "keywords": ["string", "..."],\n'
-        '  "objects": [{"name": "string", "confidence": 0..1}],\n'
-        '  "colors": ["string"],\n'
-        '  "is_eyewear_present": boolean\n'
-        "}\n"
-        "Be accurate and avoid speculation."
-    )
-    resp = client.chat.completions.create(
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    _sha_cache[key] = digest
+    return digest
+
+def pages_to_process(
+    pdf_path: Path, sha: str, pdf_filename: str, web_path: str
+) -> tuple[list[int], dict[str, dict]]:
+    """
+    (1-based page numbers with no stored row yet, {id: raw_metadata} of
+    stored pages that only need a new embedding). Rows that are already
+    there get repointed at this file's current name and path, so a renamed
+    or re-uploaded PDF doesn't leave dead links.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    ids = {n: f"{sha}-p{n}" for n in range(1, page_count + 1)}
+    with session_scope() as s:
+        embedded, unembedded = stored_pages(s, list(ids.values()))
+        existing = embedded | unembedded.keys()
+        if existing:
+            repoint_pages(s, list(existing), pdf_filename, web_path)
+    todo = [n for n, row_id in ids.items() if row_id not in existing]
+    return todo, unembedded
+
+async def reembed_pages(pages: dict[str, dict], pdf_filename: str):
+    """
+    New vectors for pages whose vision output is stored but whose embedding
+    was dropped (e.g. by an embedding-size migration); no vision calls.
+    """
+    ids = list(pages)
+    texts = [build_text_for_embedding(pages[i], fallback_filename=pdf_filename) for i in ids]
+    vectors = await embed_texts_batch_async(texts)
+
+    def store():
+        with session_scope() as s:
+            update_embeddings(s, dict(zip(ids, vectors)))
+
+    await asyncio.to_thread(store)
+    print(f"✓ Re-embedded {pdf_filename} ({len(ids)} pages)")
+
+RENDER_WORKERS = min(os.cpu_count() or 1, 4)
+RENDER_WINDOW = RENDER_WORKERS * 2  # pages in flight per PDF; bounds memory
+RENDER_DPI = 150
+
+# JPEG keeps the base64 payload to the vision API several times smaller than
+# PNG; switch to "png" where lossless line art matters.
+IMAGE_FORMAT = "jpeg"
+JPEG_QUALITY = 85
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+def render_pool() -> ProcessPoolExecutor:
+    # one pool per process, so concurrent PDFs share the RENDER_WORKERS cap.
+    # forkserver rather than fork: forking the threaded server process can
+    # copy held locks into the child. Workers only need the render module.
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["render"])
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=ctx)
+        return _render_pool
+
+def image_bytes_to_data_url(img_bytes: bytes, mime: str) -> str:
+    b64 = base64.b64encode(img_bytes).decode("ascii")
+    return f"data:{mime};base64,{b64}"
+
+_VISION_SYSTEM = "You are an image metadata extractor. Return concise JSON only."
+_VISION_USER = (
+    "Extract this schema:\n"
+    "{\n"
+    '  "caption": "string (<= 15 words)",\n'
+    '  "keywords": ["string", "..."],\n'
+    '  "objects": [{"name": "string", "confidence": 0..1}],\n'
+    '  "colors": ["string"],\n'
+    '  "is_eyewear_present": boolean\n'
+    "}\n"
+    "Be accurate and avoid speculation."
+)
+
+def build_vision_messages(img_bytes: bytes, mime: str) -> list[dict]:
+    data_url = image_bytes_to_data_url(img_bytes, mime)
+    return [
+        {"role": "system", "content": _VISION_SYSTEM},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": _VISION_USER},
+                {"type": "image_url", "image_url": {"url": data_url}},
+            ],
+        },
+    ]
+
+async def call_vision_async(img_bytes: bytes, mime: str = f"image/{IMAGE_FORMAT}") -> dict:
+    resp = await aclient.chat.completions.create(
         model="gpt-4o-mini",
         response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": SYSTEM},
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": USER},
-                    {"type": "image_url", "image_url": {"url": data_url}},
-                ],
-            },
-        ],
+        messages=build_vision_messages(img_bytes, mime),
         temperature=0.2,
     )
-    import json
-    return json.loads(resp.choices[0].message.content)
+    return orjson.loads(resp.choices[0].message.content)
+
+EMBED_MODEL = "text-embedding-3-large"
+EMBED_BATCH_SIZE = 96  # inputs per request, well under the per-request token limit
+
+def l2_normalize(vec: list[float]) -> list[float]:
+    # unit length lets /search rank by inner product instead of cosine
+    norm = math.sqrt(sum(v * v for v in vec)) + 1e-12
+    return [v / norm for v in vec]
+
+async def embed_texts_batch_async(texts: list[str]) -> list[list[float]]:
+    vectors: list[list[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        chunk = texts[start:start + EMBED_BATCH_SIZE]
+        emb = await aclient.embeddings.create(model=EMBED_MODEL, input=chunk, dimensions=EMBEDDING_DIM)
+        # results carry their input index; don't rely on response order
+        vectors.extend(l2_normalize(d.embedding) for d in sorted(emb.data, key=lambda d: d.index))
+    return vectors
 
-def embed_text(text: str) -> list[float]:
-    emb = client.embeddings.create(model="text-embedding-3-large", input=text)
-    return emb.data[0].embedding
+async def embed_text(text: str) -> list[float]:
+    return (await embed_texts_batch_async([text]))[0]
 
 def build_text_for_embedding(meta: dict, fallback_filename: str) -> str:
     caption = meta.get("caption") or ""
@@ -111,36 +203,141 @@ def build_text_for_embedding(meta: dict, fallback_filename: str) -> str:
 
 # ---------- Core pipeline ----------
 
-def process_pdf(pdf_path: Path, web_path_for_ui: str | None = None):
-    sha = file_sha256(pdf_path)
+async def process_pdf_async(pdf_path: Path, web_path_for_ui: str | None = None):
+    """
+    Staged pipeline: render -> vision -> embed -> DB, connected by bounded
+    queues so every stage works on a different page at the same time.
+    """
+    sha = await asyncio.to_thread(file_sha256, pdf_path)
     pdf_filename = pdf_path.name
     web_path = web_path_for_ui or f"/samples/{pdf_filename}"
 
-    for page_number, png_bytes, (w, h) in render_pdf_pages(pdf_path):
-        meta = call_openai_vision(png_bytes)
-        text_for_embedding = build_text_for_embedding(meta, fallback_filename=pdf_filename)
-        vector = embed_text(text_for_embedding)
+    todo, unembedded = await asyncio.to_thread(pages_to_process, pdf_path, sha, pdf_filename, web_path)
+    if unembedded:
+        await reembed_pages(unembedded, pdf_filename)
+    if not todo:
+        print(f"↷ Skipped {pdf_filename} (already indexed)")
+        return
 
-        row_id = f"{sha}-p{page_number}"
-        with session_scope() as s:
-            upsert_image_page(
-                s,
-                id=row_id,
-                pdf_filename=pdf_filename,
-                pdf_path=web_path,
-                page_number=page_number,
-                width=w,
-                height=h,
-                size_bytes=len(png_bytes),
-                caption=meta.get("caption"),
-                keywords=meta.get("keywords"),
-                raw_metadata=meta,
-                embedding=vector,
-            )
-        print(f"✓ Stored {pdf_filename} page {page_number}")
+    render_q: asyncio.Queue = asyncio.Queue(maxsize=4)
+    vision_q: asyncio.Queue = asyncio.Queue(maxsize=16)
+    db_q: asyncio.Queue = asyncio.Queue(maxsize=32)
+
+    async def render_stage():
+        # submit straight to the pool so cancelling this task cancels the
+        # queued renders; at most RENDER_WINDOW pages are in flight
+        loop = asyncio.get_running_loop()
+        pool = render_pool()
+        doc_key = (str(pdf_path), pdf_path.stat().st_mtime_ns)
+        in_flight: deque = deque()
+        try:
+            for n in todo:
+                in_flight.append(loop.run_in_executor(
+                    pool, render_one, *doc_key, n - 1, RENDER_DPI, IMAGE_FORMAT, JPEG_QUALITY
+                ))
+                if len(in_flight) >= RENDER_WINDOW:
+                    await render_q.put(await in_flight.popleft())
+            while in_flight:
+                await render_q.put(await in_flight.popleft())
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+        for _ in range(VISION_CONCURRENCY):
+            await render_q.put(_DONE)
+
+    async def vision_stage():
+        while (page := await render_q.get()) is not _DONE:
+            page_number, img_bytes, (w, h) = page
+            meta = await call_vision_async(img_bytes)
+            text_for_embedding = build_text_for_embedding(meta, fallback_filename=pdf_filename)
+            await vision_q.put((page_number, len(img_bytes), w, h, meta, text_for_embedding))
+        await vision_q.put(_DONE)
+
+    async def embed_stage():
+        open_workers = VISION_CONCURRENCY
+        while open_workers:
+            batch, open_workers = await _next_batch(vision_q, EMBED_BATCH_SIZE, open_workers)
+            if not batch:
+                continue
+            vectors = await embed_texts_batch_async([t for *_, t in batch])
+            for item, vector in zip(batch, vectors):
+                await db_q.put(page_row(sha, pdf_filename, web_path, item, vector))
+        await db_q.put(_DONE)
+
+    async def db_stage():
+        open_workers = 1
+        while open_workers:
+            rows, open_workers = await _next_batch(db_q, DB_BATCH_SIZE, open_workers)
+            if rows:
+                await asyncio.to_thread(write_rows, pdf_filename, rows)
+
+    # a failing stage cancels the rest instead of leaving them blocked on queues
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(render_stage())
+        for _ in range(VISION_CONCURRENCY):
+            tg.create_task(vision_stage())
+        tg.create_task(embed_stage())
+        tg.create_task(db_stage())
+
+async def _next_batch(q: asyncio.Queue, limit: int, open_workers: int) -> tuple[list, int]:
+    """
+    Wait for the next item on q, then drain whatever else is already queued,
+    up to `limit`. Batches stay large under load and flush as soon as the
+    queue goes idle. Returns the batch and how many workers are still open.
+    """
+    batch: list = []
+    item = await q.get()
+    while True:
+        if item is _DONE:
+            open_workers -= 1
+        else:
+            batch.append(item)
+        if not open_workers or len(batch) >= limit:
+            break
+        try:
+            item = q.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+    return batch, open_workers
+
+def page_row(sha: str, pdf_filename: str, web_path: str, item: tuple, vector: list[float]) -> dict:
+    page_number, size_bytes, w, h, meta, _ = item
+    return dict(
+        id=f"{sha}-p{page_number}",
+        pdf_filename=pdf_filename,
+        pdf_path=web_path,
+        page_number=page_number,
+        width=w,
+        height=h,
+        size_bytes=size_bytes,
+        caption=meta.get("caption"),
+        keywords=meta.get("keywords"),
+        raw_metadata=meta,
+        embedding=vector,
+    )
+
+# rows per DB write in the async pipeline; well past COPY_THRESHOLD so large
+# PDFs take the COPY path
+DB_BATCH_SIZE = 256
+
+def write_rows(pdf_filename: str, rows: list[dict]):
+    with session_scope() as s:
+        if len(rows) >= COPY_THRESHOLD:
+            copy_upsert_image_pages(s, rows)
+        else:
+            insert_image_pages(s, rows)
+    print(f"✓ Stored {pdf_filename} ({len(rows)} pages)")
 
 # ---------- API ----------
 SAMPLES_DIR = (Path(__file__).resolve().parents[1] / "frontend" / "public" / "samples")
+
+def present_sample_files() -> set[str]:
+    # one directory listing instead of a stat per DB row
+    try:
+        return {e.name for e in os.scandir(SAMPLES_DIR) if e.is_file()}
+    except FileNotFoundError:
+        return set()
+
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     # save into Next.js public/samples so the browser can reach it at /samples/<name>
@@ -150,20 +347,21 @@ async def upload(file: UploadFile = File(...)):
         f.write(await file.read())
 
     # run your existing pipeline (renders page 1, hits OpenAI, stores to Postgres)
-    process_pdf(target, web_path_for_ui=f"/samples/{file.filename}")
+    await process_pdf_async(target, web_path_for_ui=f"/samples/{file.filename}")
 
     return {"ok": True, "file": file.filename, "web_path": f"/samples/{file.filename}"}
 @app.post("/admin/cleanup-missing")
 def cleanup_missing():
     removed: list[str] = []
+    present = present_sample_files()
     with session_scope() as s:
         rows = s.execute(text("SELECT DISTINCT pdf_filename, pdf_path FROM image_pages")).all()
         for fn, web_path in rows:
-            fs_path = SAMPLES_DIR / Path(web_path).name
-            if not fs_path.exists():
-                s.execute(text("DELETE FROM image_pages WHERE pdf_filename = :fn"), {"fn": fn})
+            if Path(web_path).name not in present:
                 removed.append(fn)
-        s.commit()
+        if removed:
+            # one statement for all missing files; session_scope commits
+            s.execute(text("DELETE FROM image_pages WHERE pdf_filename = ANY(:fns)"), {"fns": removed})
     return {"ok": True, "removed": removed}
 @app.get("/health")
 def health():
@@ -191,55 +389,67 @@ def items():
             ORDER BY pdf_filename, page_number
         """)).mappings().all()
 
-    def exists(r):
-        p = SAMPLES_DIR / Path(r["pdf_path"]).name
-        return p.exists()
-
-    return {"ok": True, "items": [dict(r) for r in rows if exists(r)]}
+    present = present_sample_files()
+    return {"ok": True, "items": [dict(r) for r in rows if Path(r["pdf_path"]).name in present]}
 
 @app.post("/ingest/scan")
-def ingest_scan(folder: str = "../frontend/public/samples"):
+async def ingest_scan(folder: str = "../frontend/public/samples"):
     # same as /ingest/local – it will upsert and skip existing pages
-    return ingest_local(folder)
+    return await ingest_local(folder)
 
 @app.post("/ingest/local")
-def ingest_local(folder: str = "../frontend/public/samples"):
+async def ingest_local(folder: str = "../frontend/public/samples"):
     folder_path = Path(folder).resolve()
     if not folder_path.exists():
         return {"ok": False, "error": f"Folder not found: {folder_path}"}
     pdfs = sorted(folder_path.glob("*.pdf"))
     if not pdfs:
         return {"ok": False, "error": f"No PDFs in {folder_path}"}
-    for pdf in pdfs:
-        web_path = f"/samples/{pdf.name}"
-        process_pdf(pdf, web_path_for_ui=web_path)
+    sem = asyncio.Semaphore(PDF_CONCURRENCY)
+
+    async def ingest_one(pdf: Path):
+        async with sem:
+            await process_pdf_async(pdf, web_path_for_ui=f"/samples/{pdf.name}")
+
+    # a failure cancels the sibling ingests instead of leaving them running
+    async with asyncio.TaskGroup() as tg:
+        for pdf in pdfs:
+            tg.create_task(ingest_one(pdf))
     return {"ok": True, "processed": len(pdfs)}
 
+# Built once: SQLAlchemy reuses the compiled statement and psycopg can
+# keep it server-side prepared across requests.
+# Typed bind params so :query_vec is a pgvector halfvec; vectors are unit
+# length, so negative inner product ranks like cosine.
+SEARCH_SQL = text("""
+    SELECT id, pdf_filename, page_number, caption, keywords, pdf_path,
+           -(embedding <#> :query_vec) AS score
+    FROM image_pages
+    ORDER BY embedding <#> :query_vec
+    LIMIT :k
+""").bindparams(
+    bindparam("query_vec", type_=HALFVEC(EMBEDDING_DIM)),
+    bindparam("k", type_=Integer),
+)
+# recall/latency knob for the HNSW scan, scoped to the current transaction
+EF_SEARCH_SQL = text("SELECT set_config('hnsw.ef_search', :ef, true)")
+
+def search_rows(vec: list[float], k: int) -> list:
+    with session_scope() as s:
+        s.execute(EF_SEARCH_SQL, {"ef": str(HNSW_EF_SEARCH)})
+        return s.execute(SEARCH_SQL, {"query_vec": vec, "k": k}).mappings().all()
+
 @app.post("/search")
-def search(q: str = Body(embed=True), k: int = 24):
+async def search(q: str = Body(embed=True), k: int = 24):
     q = (q or "").strip()
     if not q:
         return {"ok": True, "results": []}
 
     # 1) Embed the query
-    vec = client.embeddings.create(
-        model="text-embedding-3-large", input=q
-    ).data[0].embedding
-
-    # 2) SQL with typed bind params (so :query_vec is a pgvector)
-    sql = text("""
-        SELECT id, pdf_filename, page_number, caption, keywords, pdf_path,
-               1 - (embedding <=> :query_vec) AS score
-        FROM image_pages
-        ORDER BY embedding <=> :query_vec
-        LIMIT :k
-    """).bindparams(
-        bindparam("query_vec", type_=Vector(3072)),
-        bindparam("k", type_=Integer),
-    )
+    vec = await embed_text(q)
 
-    with session_scope() as s:
-        rows = s.execute(sql, {"query_vec": vec, "k": k}).mappings().all()
+    # 2) Nearest pages via the HNSW index
+    rows = await asyncio.to_thread(search_rows, vec, k)
 
     return {"ok": True, "results": [dict(r) for r in rows]}
 # ---------- CLI ----------
@@ -248,5 +458,5 @@ if __name__ == "__main__":
     init_db()
     samples = Path(__file__).resolve().parents[1] / "frontend" / "public" / "samples"
     print(f"Ingesting from: {samples}")
-    for p in sorted(samples.glob("*.pdf")):
-        process_pdf(p, web_path_for_ui=f"/samples/{p.name}")
+    print(asyncio.run(ingest_local(str(samples))))
+    create_embedding_index()
@@ -0,0 +1,37 @@
+# backend/render.py
+# Page rendering for the worker pool. Imports only PyMuPDF so worker
+# processes start without the app's env, API clients or DB engine.
+from functools import lru_cache
+from typing import Tuple
+
+import fitz  # PyMuPDF
+
+# gpt-4o-mini tiles images internally; pixels past this long side only add payload
+MAX_IMAGE_SIDE = 1536
+
+# documents kept open per worker; matches the PDFs ingested at once
+DOC_CACHE_SIZE = 4
+
+@lru_cache(maxsize=DOC_CACHE_SIZE)
+def _worker_doc(pdf_path: str, mtime_ns: int):
+    # MuPDF documents can't be pickled, so each worker opens and keeps its own
+    # copy; mtime_ns in the key makes an overwritten upload reopen
+    return fitz.open(pdf_path)
+
+def _render_page(page, dpi: int, fmt: str, quality: int) -> Tuple[bytes, Tuple[int, int]]:
+    zoom = dpi / 72
+    long_side = max(page.rect.width, page.rect.height) * zoom
+    if long_side > MAX_IMAGE_SIDE:
+        # shrink the render matrix up front rather than rendering big and resizing
+        zoom *= MAX_IMAGE_SIDE / long_side
+    mat = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=mat, alpha=False)
+    if fmt == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=quality), (pix.width, pix.height)
+    return pix.tobytes("png"), (pix.width, pix.height)
+
+def render_one(
+    pdf_path: str, mtime_ns: int, page_idx: int, dpi: int, fmt: str, quality: int
+) -> Tuple[int, bytes, Tuple[int, int]]:
+    img, size = _render_page(_worker_doc(pdf_path, mtime_ns)[page_idx], dpi, fmt, quality)
+    return page_idx + 1, img, size